@@ -1,10 +1,22 @@
-import json
+import asyncio
+import csv
+import random
 import time
-import requests
-import pandas as pd
-from difflib import SequenceMatcher
+import httpx
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from collections import OrderedDict, defaultdict
+from rapidfuzz import fuzz, process, utils
 from pathlib import Path
 
+# Caché de queries en disco (opcional)
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
 # ============================================
 # 1) CONFIGURACIÓN
 # ============================================
@@ -12,150 +24,279 @@ from pathlib import Path
 BASE_DIR = Path(__file__).resolve().parent.parent / "landing"
 INPUT_FILE = BASE_DIR / "goodreads_books.json"
 OUTPUT_FILE = BASE_DIR / "googlebooks_books.csv"
+OUTPUT_COLS = [
+    "gb_id", "google_id", "title", "authors", "publisher",
+    "pub_date", "categories", "isbn13",
+    "price_amount", "price_currency"
+]
 
-# Sesión HTTP persistente (más rápida y eficiente)
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+HEADERS = {"User-Agent": "Mozilla/5.0"}
 
 # Endpoint de Google Books
 API_URL = "https://www.googleapis.com/books/v1/volumes"
+MAX_RESULTS = 40  # límite del API por petición
+
+# Libros procesados en paralelo (las peticiones son I/O puro)
+CONCURRENCY = 16
+
+# Ritmo sostenido frente al API y reintentos ante 429
+QUOTA_PER_SEC = 10
+BACKOFF_BASE = 0.5   # segundos
+BACKOFF_CAP = 30     # segundos
+MAX_RETRIES = 5
+
+# Memoización de queries: en memoria (LRU) + en disco entre ejecuciones
+QUERY_MEMO_SIZE = 4096
+QUERY_CACHE_DIR = BASE_DIR / ".query_cache"
+QUERY_CACHE_TTL = 7 * 86400  # 7 días
 
 
 # ============================================
 # 2) UTILIDADES DE SIMILITUD
 # ============================================
- #   Calcula una similitud entre 0 y 1 usando SequenceMatcher.
+ #   Las cadenas se normalizan UNA vez (_norm) y luego se puntúan en
+ #   bloque con rapidfuzz (process.cdist + WRatio, 0..100).
  #   Se usa para comparar títulos y autores.
-    
 
-def similarity(a, b):
-    if not a or not b:
-        return 0
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+def _norm(s):
+    """Minúsculas, sin puntuación ni espacios extra (rapidfuzz default_process)."""
+    return utils.default_process(s) if s else ""
+
+
+def similarity_scores(query, choices):
+    """Similitud WRatio (0..100) de `query` contra cada elemento de `choices`."""
+    return process.cdist([query], choices, scorer=fuzz.WRatio, dtype=np.float64)[0]
+
+
+# ============================================
+# 3) CONTROL DE RITMO (TOKEN BUCKET + BACKOFF)
+# ============================================
+
+class RateLimiter:
+    """
+    Token bucket compartido por todas las tareas.
+    Admite ráfagas de hasta `rate` peticiones y un ritmo sostenido
+    de `rate` peticiones/segundo; los tokens se reponen según el
+    tiempo transcurrido (monotonic).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Espera antes de reintentar tras un 429.
+    Respeta Retry-After (en segundos) si el API lo envía;
+    si no, backoff exponencial con tope y jitter.
+    """
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, BACKOFF_BASE)
 
 
 # ============================================
-# 3) DESCARGAR TODOS LOS RESULTADOS DE GOOGLE BOOKS
+# 4) DESCARGAR TODOS LOS RESULTADOS DE GOOGLE BOOKS
 # ============================================
 
-def search_api_all(query):
+async def fetch_page(client, q, start):
+    """
+    Descarga UNA página de resultados de Google Books.
+    Devuelve (status_code, json, Retry-After) — json es None si status != 200.
+    """
+    res = await client.get(
+        API_URL,
+        params={
+            "q": q,
+            "printType": "books",
+            "maxResults": MAX_RESULTS,
+            "startIndex": start
+        }
+    )
+    if res.status_code != 200:
+        return res.status_code, None, res.headers.get("Retry-After")
+    return res.status_code, res.json(), None
+
+
+async def fetch_all_pages(client, limiter, query):
     """
     Recupera TODOS los resultados posibles de Google Books.
     Usa paginación (startIndex) hasta que no haya más.
     
     Google Books permite máximo 40 resultados por petición.
+    Devuelve (items, completo) — completo=False si se cortó por error.
     """
     results = []
     start = 0
-    max_results = 40  # límite del API
+    attempt = 0
+    complete = False
 
     while True:
         try:
-            # Petición
-            res = SESSION.get(
-                API_URL,
-                params={
-                    "q": query,
-                    "printType": "books",
-                    "maxResults": max_results,
-                    "startIndex": start
-                },
-                timeout=5
-            )
-
-            # Rate limit → espera y reintenta
-            if res.status_code == 429:
-                time.sleep(2)
+            # Petición (esperando turno en el token bucket)
+            await limiter.acquire()
+            status, data, retry_after = await fetch_page(client, query, start)
+
+            # Rate limit → backoff y reintenta (con tope de intentos)
+            if status == 429:
+                if attempt >= MAX_RETRIES:
+                    break
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+                attempt += 1
                 continue
+            attempt = 0
 
             # Error → salimos
-            if res.status_code != 200:
+            if status != 200:
                 break
 
-            data = res.json()
             items = data.get("items", [])
 
             # Si no hay más resultados → terminamos
             if not items:
+                complete = True
                 break
 
             results.extend(items)
 
             # Si recibimos menos de 40, no hay más páginas
-            if len(items) < max_results:
+            if len(items) < MAX_RESULTS:
+                complete = True
                 break
 
             # Siguiente página
-            start += max_results
-            time.sleep(0.3)
+            start += MAX_RESULTS
 
         except Exception:
             break
 
+    return results, complete
+
+
+_QUERY_MEMO = OrderedDict()
+
+
+def open_query_cache():
+    """Abre la caché de queries en disco (None si diskcache no está instalado)."""
+    if diskcache is None:
+        return None
+    return diskcache.Cache(str(QUERY_CACHE_DIR))
+
+
+async def search_api_all(client, limiter, query, cache=None):
+    """
+    Versión memoizada de fetch_all_pages, con la query literal como clave.
+    Primero mira la LRU en memoria, luego la caché en disco; solo se
+    guardan respuestas completas (no las cortadas por error o 429).
+    """
+    if query in _QUERY_MEMO:
+        _QUERY_MEMO.move_to_end(query)
+        return _QUERY_MEMO[query]
+
+    results = cache.get(query) if cache is not None else None
+    if results is None:
+        results, complete = await fetch_all_pages(client, limiter, query)
+        if not complete:
+            return results
+        if cache is not None:
+            cache.set(query, results, expire=QUERY_CACHE_TTL)
+
+    _QUERY_MEMO[query] = results
+    if len(_QUERY_MEMO) > QUERY_MEMO_SIZE:
+        _QUERY_MEMO.popitem(last=False)
     return results
 
 
 # ============================================
-# 4) ELEGIR EL MEJOR RESULTADO (MATCH)
+# 5) ELEGIR EL MEJOR RESULTADO (MATCH)
 # ============================================
 
+def _isbns(identifiers):
+    """
+    (ISBN_13, ISBN_10) de una lista industryIdentifiers, en una sola
+    pasada y sin construir un dict por candidato.
+    """
+    isbn13 = isbn10 = None
+    for x in identifiers:
+        t = x.get("type")
+        if t == "ISBN_13":
+            isbn13 = x.get("identifier")
+        elif t == "ISBN_10":
+            isbn10 = x.get("identifier")
+    return isbn13, isbn10
+
+
 def choose_best_result(gr_book, results):
     """
     Evalúa todos los resultados devueltos por Google Books
     y selecciona el que más se parece al libro de Goodreads.
 
     Criterios usados (modelo recomendado):
-      +100 si ISBN_13 coincide EXACTO
+      ISBN_13 coincide EXACTO → se elige directamente
       +80  si ISBN_10 coincide EXACTO
       +50 * similitud de título
       +30 * similitud de autor
     """
-    best = None
-    best_score = 0
+    if not results:
+        return None
 
-    # Campos del libro de Goodreads
-    gr_title = gr_book.get("title", "")
-    gr_author = (gr_book.get("authors") or [""])[0]
+    # Campos del libro de Goodreads (normalizados una sola vez)
+    gr_title = _norm(gr_book.get("title"))
+    gr_author = _norm((gr_book.get("authors") or [""])[0])
     gr_isbn13 = gr_book.get("isbn13")
-    gr_isbn10 = None
-    if gr_book.get("isbn13") and len(gr_book["isbn13"]) == 10:
-        gr_isbn10 = gr_book["isbn13"]
-
-    # Evaluar cada resultado de Google
-    for item in results:
-        vol = item.get("volumeInfo", {})
-        ids = {
-            x.get("type"): x.get("identifier")
-            for x in vol.get("industryIdentifiers", [])
-        }
-
-        score = 0
-
-        # 1) Coincidencia EXACTA de ISBN (criterio más fuerte)
-        if gr_isbn13 and ids.get("ISBN_13") == gr_isbn13:
-            score += 100
+    # ISBN-10 de su propio campo ('isbn10', o el legado 'isbn')
+    gr_isbn10 = gr_book.get("isbn10") or gr_book.get("isbn")
 
-        if gr_isbn10 and ids.get("ISBN_10") == gr_isbn10:
-            score += 80
+    vols = [item.get("volumeInfo", {}) for item in results]
+    isbns = [_isbns(vol.get("industryIdentifiers", [])) for vol in vols]
 
-        # 2) Similaridad de título
-        score += similarity(gr_title, vol.get("title", "")) * 50
+    # 1) Coincidencia EXACTA de ISBN-13 (criterio más fuerte).
+    # Es un identificador único: ningún otro candidato puede ser
+    # mejor, así que cortamos sin calcular similitudes.
+    if gr_isbn13:
+        for item, (isbn13, _) in zip(results, isbns):
+            if isbn13 == gr_isbn13:
+                return item
 
-        # 3) Similaridad de autor
-        authors_list = vol.get("authors", [""])
-        if authors_list:
-            score += similarity(gr_author, authors_list[0]) * 30
+    # 2) Puntuación vectorizada de todos los candidatos a la vez
+    cand_titles = [_norm(vol.get("title")) for vol in vols]
+    cand_authors = [_norm((vol.get("authors") or [""])[0]) for vol in vols]
 
-        # Guardar el mejor resultado encontrado
-        if score > best_score:
-            best_score = score
-            best = item
+    isbn10_eq = np.array([
+        bool(gr_isbn10) and isbn10 == gr_isbn10
+        for _, isbn10 in isbns
+    ])
+    scores = (80 * isbn10_eq
+              + 0.5 * similarity_scores(gr_title, cand_titles)
+              + 0.3 * similarity_scores(gr_author, cand_authors))
 
-    return best
+    # Mejor resultado (el primero en caso de empate); sin puntuación → None
+    best_idx = int(np.argmax(scores))
+    return results[best_idx] if scores[best_idx] > 0 else None
 
 
 # ============================================
-# 5) EXTRAER DATOS LIMPIOS DEL RESULTADO GOOGLE BOOKS
+# 6) EXTRAER DATOS LIMPIOS DEL RESULTADO GOOGLE BOOKS
 # ============================================
 
 def extract_data(gr_id, item):
@@ -169,8 +310,7 @@ def extract_data(gr_id, item):
     vol = item.get("volumeInfo", {})
     sale = item.get("saleInfo", {})
 
-    ids = {x.get("type"): x.get("identifier")
-           for x in vol.get("industryIdentifiers", [])}
+    isbn13, _ = _isbns(vol.get("industryIdentifiers", []))
 
     price = sale.get("listPrice") or sale.get("retailPrice") or {}
 
@@ -182,119 +322,209 @@ def extract_data(gr_id, item):
         "publisher": vol.get("publisher"),
         "pub_date": vol.get("publishedDate"),
         "categories": " | ".join(vol.get("categories", [])) if vol.get("categories") else None,
-        "isbn13": ids.get("ISBN_13"),
+        "isbn13": isbn13,
         "price_amount": price.get("amount"),
         "price_currency": price.get("currencyCode")
     }
 
 
 # ============================================
-# 6) PROCESO PRINCIPAL (CORREGIDO Y FINAL)
+# 7) PROCESAR UN GRUPO DE LIBROS (QUERIES + MATCH)
 # ============================================
 
-def main():
-    if not INPUT_FILE.exists():
-        print("ERROR: no existe goodreads_books.json")
-        return
+def query_key(book):
+    """
+    Clave (isbn13, título normalizado, primer autor normalizado).
+    Ediciones con la misma clave lanzarían las mismas queries.
+    """
+    return (
+        book.get("isbn13") or "",
+        _norm(book.get("title")),
+        _norm((book.get("authors") or [""])[0])
+    )
 
-    # ----------------------------------------
-    # A) Cargar IDs ya procesados (idempotencia)
-    # ----------------------------------------
-    processed_ids = set()
-    if OUTPUT_FILE.exists():
-        try:
-            df_old = pd.read_csv(OUTPUT_FILE, sep=";", dtype=str)
-            processed_ids = set(df_old["gb_id"])
-        except:
-            pass
 
-    # ----------------------------------------
-    # B) Cargar todos los libros de Goodreads
-    # ----------------------------------------
-    books = []
-    with open(INPUT_FILE, "r", encoding="utf-8") as f:
+def score_books(books, results):
+    """
+    Elige el mejor resultado de `results` para cada libro.
+    Es una sola llamada a cdist por libro: barata, se hace en línea.
+    """
+    return [choose_best_result(book, results) for book in books]
+
+
+async def process_group(client, limiter, cache, books):
+    """
+    Lanza las estrategias de búsqueda UNA vez para un grupo de libros
+    de Goodreads que comparten query_key y elige el mejor resultado
+    para cada uno. Devuelve [(libro, item_google | None)].
+    El RateLimiter fija el ritmo sostenido de peticiones.
+    """
+    title = books[0].get("title")
+    first_author = (books[0].get("authors") or [""])[0]
+    isbn13 = books[0].get("isbn13")
+
+    # Estrategias de búsqueda
+    queries = [
+        f"isbn:{isbn13}" if isbn13 else None,
+        f'intitle:"{title}" inauthor:"{first_author}"',
+        f'intitle:"{title}"'
+    ]
+
+    # Las queries por título/autor solo se lanzan para los libros que
+    # sigan sin candidato (p. ej. el ISBN no devolvió resultados).
+    found = {}
+    pending = list(books)
+
+    for q in queries:
+        if not q or not pending:
+            continue
+
+        all_results = await search_api_all(client, limiter, q, cache)
+
+        if all_results:
+            # 1. Buscamos si hay un candidato bueno en esta lista.
+            # Búsqueda por ISBN con un único resultado: es ese libro,
+            # no hace falta puntuar candidatos.
+            if q == queries[0] and len(all_results) == 1:
+                candidates = [all_results[0]] * len(pending)
+            else:
+                candidates = score_books(pending, all_results)
+
+            still_pending = []
+            for book, candidate in zip(pending, candidates):
+                # 2. SOLO damos el libro por resuelto si el candidato es válido.
+                # Si candidate es None (porque los resultados eran malos), seguimos probando queries.
+                if candidate:
+                    found[book["id"]] = candidate
+                else:
+                    still_pending.append(book)
+            pending = still_pending
+
+    return [(book, found.get(book["id"])) for book in books]
+
+
+# ============================================
+# 8) PROCESO PRINCIPAL
+# ============================================
+
+def iter_books(path, processed_ids):
+    """
+    Genera (de forma perezosa) los libros de Goodreads aún no procesados.
+    Lee el JSONL línea a línea con orjson.
+    """
+    with open(path, "rb") as f:
         for line in f:
             if not line.strip():
                 continue
-            b = json.loads(line)
+            b = orjson.loads(line)
             if b["id"] not in processed_ids:
-                books.append(b)
+                yield b
 
-    print(f"Se procesarán {len(books)} libros nuevos de Goodreads")
 
-    if not books:
-        print("Todo al día, no hay libros nuevos.")
+async def main():
+    if not INPUT_FILE.exists():
+        print("ERROR: no existe goodreads_books.json")
         return
 
     # ----------------------------------------
-    # C) Procesar cada libro de Goodreads
+    # A) Cargar IDs ya procesados (idempotencia)
     # ----------------------------------------
-    results = []
-
-    for i, book in enumerate(books, 1):
-
-        title = book.get("title")
-        first_author = (book.get("authors") or [""])[0]
-        isbn13 = book.get("isbn13")
-
-        # Estrategias de búsqueda
-        queries = [
-            f"isbn:{isbn13}" if isbn13 else None,
-            f'intitle:"{title}" inauthor:"{first_author}"',
-            f'intitle:"{title}"'
-        ]
-
-        google_item = None
+    processed_ids = frozenset()
+    if OUTPUT_FILE.exists():
+        # Arrow rechaza las filas incompletas (p. ej. la última línea de una
+        # ejecución cortada): se saltan y su gb_id se recupera aparte.
+        truncated = []
 
-        # --- Bucle de Queries Corregido ---
-        for q in queries:
-            if not q:
-                continue
+        def keep_truncated(row):
+            truncated.append(row.text)
+            return "skip"
 
-            all_results = search_api_all(q)
+        try:
+            # Solo se lee la columna gb_id (lector CSV de Arrow)
+            table = pacsv.read_csv(
+                OUTPUT_FILE,
+                parse_options=pacsv.ParseOptions(
+                    delimiter=";", newlines_in_values=True,
+                    invalid_row_handler=keep_truncated
+                ),
+                convert_options=pacsv.ConvertOptions(
+                    include_columns=["gb_id"],
+                    column_types={"gb_id": pa.string()}
+                )
+            )
+            ids = table.column("gb_id").to_pylist()
+            gb_col = OUTPUT_COLS.index("gb_id")
+            for fields in csv.reader(truncated, delimiter=";"):
+                if len(fields) > gb_col:
+                    ids.append(fields[gb_col])
+            processed_ids = frozenset(ids)
+        except (pa.ArrowException, OSError) as e:
+            print(f"AVISO: no se pudieron leer los gb_id ya procesados ({e})")
 
-            if all_results:
-                # 1. Buscamos si hay un candidato bueno en esta lista
-                candidate = choose_best_result(book, all_results)
-                
-                # 2. SOLO paramos si el candidato es válido.
-                # Si candidate es None (porque los resultados eran malos), seguimos probando queries.
-                if candidate:
-                    google_item = candidate
-                    break 
-        # ----------------------------------
+    # ----------------------------------------
+    # B) Agrupar los libros nuevos por query_key
+    # ----------------------------------------
+    # Varias ediciones del mismo libro comparten queries: se buscan una
+    # sola vez y sus resultados se reutilizan para todo el grupo.
+    query_groups = defaultdict(list)
+    for book in iter_books(INPUT_FILE, processed_ids):
+        query_groups[query_key(book)].append(book)
 
-        print(f"[{i}/{len(books)}] {title} → "
-              f"{'Encontrado' if google_item else 'NO encontrado'}")
+    if not query_groups:
+        print("Todo al día, no hay libros nuevos.")
+        return
 
-        results.append(extract_data(book["id"], google_item))
-        time.sleep(0.5) # Pausa para respetar a la API
+    print(f"Se procesarán {sum(map(len, query_groups.values()))} libros nuevos "
+          f"de Goodreads ({len(query_groups)} búsquedas distintas)")
 
     # ----------------------------------------
-    # D) Guardar resultados en CSV
+    # C) Procesar los grupos de forma concurrente
     # ----------------------------------------
-    if results:
-        df = pd.DataFrame(results)
-        cols = [
-            "gb_id", "google_id", "title", "authors", "publisher",
-            "pub_date", "categories", "isbn13",
-            "price_amount", "price_currency"
-        ]
-
-        df.to_csv(
-            OUTPUT_FILE,
-            sep=";",
-            mode="a",
-            index=False,
-            header=not OUTPUT_FILE.exists(),
-            columns=cols
-        )
-
-        print("Guardado completado.")
+    # CONCURRENCY workers consumen el mismo iterador: cada grupo lo
+    # toma un único worker y nunca hay más de CONCURRENCY en vuelo.
+    # Cada fila se escribe y se vuelca a disco en cuanto está lista,
+    # así un corte a mitad de ejecución no pierde lo ya procesado.
+    groups = iter(query_groups.values())
+    written = 0
+
+    limiter = RateLimiter(QUOTA_PER_SEC)
+    # HTTP/2: todas las peticiones en vuelo se multiplexan sobre pocas conexiones
+    limits = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+
+    cache = open_query_cache()
+    new_file = not OUTPUT_FILE.exists() or OUTPUT_FILE.stat().st_size == 0
+
+    with open(OUTPUT_FILE, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_COLS, delimiter=";",
+                                lineterminator="\n")
+        if new_file:
+            writer.writeheader()
+
+        async def worker(client):
+            nonlocal written
+            for group in groups:
+                for book, google_item in await process_group(client, limiter, cache, group):
+                    writer.writerow(extract_data(book["id"], google_item))
+                    written += 1
+                    print(f"[{written}] {book.get('title')} → "
+                          f"{'Encontrado' if google_item else 'NO encontrado'}")
+                f.flush()
+
+        try:
+            async with httpx.AsyncClient(
+                http2=True, limits=limits, headers=HEADERS, timeout=5,
+                follow_redirects=True
+            ) as client:
+                await asyncio.gather(*(worker(client) for _ in range(CONCURRENCY)))
+        finally:
+            if cache is not None:
+                cache.close()
+
+    print("Guardado completado.")
 
 # ============================================
 # EJECUCIÓN
 # ============================================
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -13,16 +13,17 @@ Salida:
 Mantiene:
  - Idempotencia (canonical_id estable)
  - Deduplicación por calidad (_score)
- - Lookups O(1) por gb_id, isbn13 y title||author
+ - Matching por gb_id, isbn13 y title+author con merges (hash joins)
  - Robust save Parquet + CSV
 """
 
 import json
-import hashlib
 import re
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Optional, Any, List, Dict
+from typing import Optional, Any, List, Dict, Tuple
+import orjson
+import xxhash
 import pandas as pd
 import numpy as np
 
@@ -59,22 +60,23 @@ METRICS = DOCS_DIR / "quality_metrics.json"
 def now_ts() -> str:
     return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
-def safe_read_goodreads(path: Path) -> pd.DataFrame:
-    if not path.exists():
-        print(f"[WARN] No existe {path}")
-        return pd.DataFrame()
-    rows = []
-    with open(path, 'r', encoding='utf-8') as f:
+def iter_jsonl(path: Path):
+    """Genera los registros de un JSONL sin cargar el fichero entero."""
+    with open(path, 'rb') as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
             try:
-                rows.append(json.loads(line))
-            except Exception:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
                 # ignorar lineas corruptas
                 continue
-    return pd.DataFrame(rows)
+
+def safe_read_goodreads(path: Path) -> pd.DataFrame:
+    if not path.exists():
+        print(f"[WARN] No existe {path}")
+        return pd.DataFrame()
+    return pd.DataFrame(iter_jsonl(path))
 
 def safe_read_google(parquet: Path, csv: Path) -> pd.DataFrame:
     df = pd.DataFrame()
@@ -92,6 +94,25 @@ def safe_read_google(parquet: Path, csv: Path) -> pd.DataFrame:
         df = df.replace({np.nan: None})
     return df
 
+def _object_columns(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Columnas como arrays de objetos Python, con None en lugar de NaN."""
+    data = df.astype(object).where(df.notna(), None)
+    return {c: data[c].to_numpy() for c in data.columns}
+
+def iter_records(df: pd.DataFrame):
+    """Recorre las filas como dicts, uno a uno, sin materializar to_dict(orient="records")."""
+    if df.empty:
+        return
+    cols = _object_columns(df)
+    names = list(cols)
+    for values in zip(*cols.values()):
+        yield dict(zip(names, values))
+
+def record_getter(df: pd.DataFrame):
+    """Devuelve f(i) → dict de la fila i; el dict solo se crea al pedirlo."""
+    cols = _object_columns(df) if not df.empty else {}
+    return lambda i: {c: arr[i] for c, arr in cols.items()}
+
 def save_dataframe_robust(df: pd.DataFrame, path: Path):
     """Guarda Parquet (si puede) y siempre escribe CSV como respaldo."""
     if df is None or df.empty:
@@ -114,6 +135,15 @@ def save_dataframe_robust(df: pd.DataFrame, path: Path):
 # NORMALIZACIÓN (compacta)
 # --------------------------
 
+# Patrones compilados una vez (se aplican por fila y por campo)
+_WS_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_AUTHOR_SEP_RE = re.compile(r"[|,;]")
+_FLOAT_INT_RE = re.compile(r"^(\d+)\.0$")
+_DATE_YMD = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})")
+_DATE_YM = re.compile(r"^(\d{4})-(\d{1,2})")
+_DATE_Y = re.compile(r"^(\d{4})")
+
 def normalize_str(val: Any) -> Optional[str]:
     if val is None:
         return None
@@ -123,21 +153,21 @@ def normalize_str(val: Any) -> Optional[str]:
     # quitar ".0" en floats serializados como strings ("123.0")
     if s.endswith(".0") and s[:-2].isdigit():
         s = s[:-2]
-    return re.sub(r"\s+", " ", s)
+    return _WS_RE.sub(" ", s)
 
 def normalize_title(title: Any) -> Optional[str]:
     t = normalize_str(title)
     if not t:
         return None
     t = t.lower()
-    t = re.sub(r"[^\w\s]", "", t)
-    return re.sub(r"\s+", " ", t).strip()
+    t = _PUNCT_RE.sub("", t)
+    return _WS_RE.sub(" ", t).strip()
 
 def normalize_author(auth: Any) -> List[str]:
     if not auth or isinstance(auth, float):
         return []
     if isinstance(auth, str):
-        parts = re.split(r"[|,;]", auth)
+        parts = _AUTHOR_SEP_RE.split(auth)
     elif isinstance(auth, list):
         parts = auth
     else:
@@ -154,9 +184,33 @@ def normalize_categories(val: Any) -> List[str]:
         return [x.strip() for x in s.split("|") if x.strip()]
     return [s.strip()]
 
-def get_first_author(auth: Any) -> str:
-    a = normalize_author(auth)
-    return a[0] if a else ""
+# Versiones por columna (pandas .str) de las funciones anteriores.
+# Devuelven dtype object con None en los huecos, igual que las escalares.
+
+def _none_for_missing(s: pd.Series) -> pd.Series:
+    s = s.mask(s.eq(""))
+    return s.astype(object).where(s.notna(), None)
+
+def normalize_str_col(col: pd.Series) -> pd.Series:
+    s = col.astype("string").str.strip()
+    s = s.mask(s.str.lower().eq("nan"))
+    s = s.str.replace(_FLOAT_INT_RE, r"\1", regex=True)
+    return _none_for_missing(s.str.replace(_WS_RE, " ", regex=True))
+
+def normalize_title_col(col: pd.Series) -> pd.Series:
+    s = normalize_str_col(col).astype("string").str.lower()
+    s = s.str.replace(_PUNCT_RE, "", regex=True)
+    return _none_for_missing(s.str.replace(_WS_RE, " ", regex=True).str.strip())
+
+def first_author_col(col: pd.Series) -> pd.Series:
+    # strings "A | B" se parten; las listas se usan tal cual; cualquier
+    # otro valor (números, bools...) no tiene autor, como en normalize_author
+    col = col.astype(object)
+    col = col.where(col.map(type).isin((str, list)))
+    parts = col.str.split(_AUTHOR_SEP_RE).fillna(col)
+    flat = normalize_str_col(parts.explode())
+    first = flat.dropna().groupby(level=0).first()
+    return first.reindex(col.index).fillna("").astype(object)
 
 def iso_date(val: Any) -> Optional[str]:
     if not val or isinstance(val, float):
@@ -176,13 +230,13 @@ def iso_date(val: Any) -> Optional[str]:
         except Exception:
             pass
     # fallback patterns
-    m = re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})", s)
+    m = _DATE_YMD.match(s)
     if m:
         return f"{m.group(1)}-{int(m.group(2)):02d}-{int(m.group(3)):02d}"
-    m = re.match(r"^(\d{4})-(\d{1,2})", s)
+    m = _DATE_YM.match(s)
     if m:
         return f"{m.group(1)}-{int(m.group(2)):02d}"
-    m = re.match(r"^(\d{4})", s)
+    m = _DATE_Y.match(s)
     if m:
         return m.group(1)
     return None
@@ -205,7 +259,8 @@ def safe_decimal(v: Any) -> Optional[float]:
         return None
 
 def stable_hash_id(fields: List[str]) -> str:
-    return hashlib.sha1("||".join(f or "" for f in fields).encode("utf-8")).hexdigest()
+    # hash no criptográfico y determinista (xxh3 sin semilla aleatoria)
+    return xxhash.xxh3_64_hexdigest("||".join(f or "" for f in fields).encode("utf-8"))
 
 # --------------------------
 # MERGE LOGIC
@@ -255,7 +310,7 @@ def merge_records(g: Dict, gg: Dict) -> Dict:
 
     pub_year = None
     if pub_date:
-        m = re.match(r"^(\d{4})", pub_date)
+        m = _DATE_Y.match(pub_date)
         if m:
             pub_year = int(m.group(1))
 
@@ -306,6 +361,68 @@ def merge_records(g: Dict, gg: Dict) -> Dict:
         "ingestion_date_google": gg.get("ingestion_date") if gg else None
     }
 
+def _str_key(col: pd.Series) -> pd.Series:
+    """str(valor) como clave de join; None si el valor es nulo o vacío."""
+    valid = col.notna() & col.astype(str).ne("")
+    return col.astype(str).where(valid, None)
+
+def _left_join_rows(left: pd.DataFrame, right: pd.DataFrame, on: List[str]) -> np.ndarray:
+    """
+    Posición (_gg_row) de la fila de `right` que casa con cada fila de `left`,
+    NaN si no hay match. `right` debe venir sin claves duplicadas ni nulas.
+    """
+    m = left[on].merge(right[on + ["_gg_row"]], on=on, how="left")
+    return m["_gg_row"].to_numpy(dtype=float)
+
+def match_google(df_good: pd.DataFrame, df_gg: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Empareja cada fila de Goodreads con una de Google en tres niveles
+    (id → isbn13 → título+autor) usando merges en lugar de lookups por fila.
+    Devuelve (posición en df_gg o NaN, merge_method) por fila de Goodreads.
+    """
+    n = len(df_good)
+    if df_gg.empty or n == 0:
+        return np.full(n, np.nan), np.full(n, "none", dtype=object)
+
+    gg = pd.DataFrame({
+        "_gb_key": _str_key(df_gg["gb_id"]),
+        "_isbn13": df_gg["_isbn13"],
+        "_title_norm": df_gg["_title_norm"],
+        "_first_author": df_gg["_first_author"],
+        "_gg_row": np.arange(len(df_gg)),
+    })
+    good = pd.DataFrame({
+        "_gb_key": _str_key(df_good.get("id", pd.Series(None, index=df_good.index, dtype=object))),
+        "_isbn13": df_good["_isbn13"],
+        "_title_norm": df_good["_title_norm"],
+        "_first_author": df_good["_first_author"],
+    })
+
+    # 1) gb_id (ante duplicados gana la última fila)
+    by_id = gg[gg["_gb_key"].notna()].drop_duplicates("_gb_key", keep="last")
+    row_id = _left_join_rows(good, by_id, ["_gb_key"])
+
+    # 2) isbn13 (ante duplicados gana la última fila)
+    by_isbn = gg[gg["_isbn13"].notna()].drop_duplicates("_isbn13", keep="last")
+    row_isbn = _left_join_rows(good, by_isbn, ["_isbn13"])
+
+    # 3) título normalizado + primer autor (gana la primera fila)
+    key = ["_title_norm", "_first_author"]
+    has_key = gg["_title_norm"].notna() & gg["_first_author"].ne("")
+    by_key = gg[has_key].drop_duplicates(key, keep="first")
+    row_key = _left_join_rows(good, by_key, key)
+
+    matched_id = ~np.isnan(row_id)
+    matched_isbn = ~np.isnan(row_isbn)
+    matched_key = ~np.isnan(row_key)
+    rows = np.where(matched_id, row_id, np.where(matched_isbn, row_isbn, row_key))
+    method = np.select(
+        [matched_id, matched_isbn, matched_key],
+        ["id", "isbn", "heuristic"],
+        default="none"
+    ).astype(object)
+    return rows, method
+
 # --------------------------
 # PIPELINE
 # --------------------------
@@ -319,51 +436,33 @@ def run_pipeline():
 
     print(f"[INFO] Goodreads: {len(df_good)} | Google: {len(df_gg)}")
 
-    # Build lookups for google records (O(1) lookups)
-    google_by_gbid = {}
-    google_by_isbn13 = {}
-    google_by_key = {}
-
+    # Normalized match keys, computed column-wise once per source
     if not df_gg.empty:
-        recs = df_gg.replace({np.nan: None}).to_dict(orient="records")
-        for r in recs:
-            if r.get("gb_id"):
-                google_by_gbid[str(r["gb_id"])] = r
-            isbn = normalize_str(r.get("isbn13"))
-            if isbn:
-                google_by_isbn13[isbn] = r
-            tnorm = normalize_title(r.get("title"))
-            afirst = get_first_author(r.get("authors"))
-            if tnorm and afirst:
-                k = f"{tnorm}||{afirst}"
-                google_by_key.setdefault(k, r)
-
-    print("[INFO] Índices Google construidos.")
+        df_gg["_isbn13"] = normalize_str_col(df_gg["isbn13"])
+        df_gg["_title_norm"] = normalize_title_col(df_gg["title"])
+        df_gg["_first_author"] = first_author_col(df_gg["authors"])
+    if not df_good.empty:
+        # isbn13, o el legado 'isbn' si falta
+        isbn_src = df_good.get("isbn13", pd.Series(None, index=df_good.index, dtype=object))
+        if "isbn" in df_good:
+            isbn_src = isbn_src.where(isbn_src.notna() & isbn_src.ne(""), df_good["isbn"])
+        df_good["_isbn13"] = normalize_str_col(isbn_src)
+        df_good["_title_norm"] = normalize_title_col(df_good["title"])
+        df_good["_first_author"] = first_author_col(df_good["authors"])
+
+    # Three-level matching as hash joins (id → isbn13 → title+author)
+    gg_rows, methods = match_google(df_good, df_gg)
+    gg_record = record_getter(df_gg)
+
+    print("[INFO] Matching con Google completado.")
 
     merged_rows = []
     detail_rows = []
-    gr_recs = df_good.replace({np.nan: None}).to_dict(orient="records") if not df_good.empty else []
 
-    for g in gr_recs:
-        matched = None
+    # Filas de Goodreads generadas una a una; de Google solo las emparejadas
+    for g, gg_row, method in zip(iter_records(df_good), gg_rows, methods):
+        matched = gg_record(int(gg_row)) if not np.isnan(gg_row) else None
         gid = str(g.get("id")) if g.get("id") is not None else ""
-        if gid and gid in google_by_gbid:
-            matched = google_by_gbid[gid]
-            method = "id"
-        else:
-            isbn = normalize_str(g.get("isbn13") or g.get("isbn"))
-            if isbn and isbn in google_by_isbn13:
-                matched = google_by_isbn13[isbn]
-                method = "isbn"
-            else:
-                tnorm = normalize_title(g.get("title"))
-                afirst = get_first_author(g.get("authors"))
-                key = f"{tnorm}||{afirst}" if tnorm and afirst else None
-                if key and key in google_by_key:
-                    matched = google_by_key[key]
-                    method = "heuristic"
-                else:
-                    method = "none"
 
         merged = merge_records(g, matched or {})
         merged_rows.append(merged)
@@ -382,9 +481,10 @@ def run_pipeline():
 
     if not df_final.empty:
         # Deduplicate by canonical_id preferring more-complete rows
-        df_final["_score"] = df_final.notnull().sum(axis=1)
-        df_final = df_final.sort_values("_score", ascending=False)
-        df_final = df_final.drop_duplicates(subset=["canonical_id"], keep="first").drop(columns=["_score"])
+        # (máximo por grupo con idxmax: sin ordenar todo el DF)
+        df_final["_score"] = df_final.notna().to_numpy().sum(axis=1)
+        keep = df_final.groupby("canonical_id", sort=False)["_score"].idxmax()
+        df_final = df_final.loc[keep].drop(columns=["_score"])
 
         # Force string types for id columns (avoid mixed types / pyarrow errors)
         for c in ["canonical_id", "isbn13", "isbn10"]:
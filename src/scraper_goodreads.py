@@ -1,20 +1,30 @@
-import requests
-import json
-import time
+import argparse
+import asyncio
+import httpx
+import orjson
+import os
 import random
 import re
-from bs4 import BeautifulSoup
-from dataclasses import dataclass, field, asdict
+from asyncio_throttle import Throttler
+from selectolax.lexbor import LexborHTMLParser
+from dataclasses import dataclass, field
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 
+# Caché de HTML en Redis (opcional)
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # --- 1. CONFIGURACIÓN ---
 CURRENT_DIR = Path(__file__).resolve().parent 
 PROJECT_ROOT = CURRENT_DIR.parent
 LANDING_DIR = PROJECT_ROOT / "landing"
 LANDING_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_FILE = LANDING_DIR / "goodreads_books.json"
+IDS_FILE = OUTPUT_FILE.with_suffix(".ids")  # un id por línea, en paralelo al JSONL
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
@@ -23,8 +33,85 @@ HEADERS = {
 BASE_BOOK_URL = "https://www.goodreads.com/book/show/"
 SEARCH_URL = "https://www.goodreads.com/search"
 
+# Expresiones regulares compiladas una sola vez
+PAGES_RE = re.compile(r'(\d+)')
+DETAILS_RE = re.compile(rb'"details"\s*:\s*({.*?})\s*,\s*"', re.DOTALL)
+ISBN10_RE = re.compile(r'^\d{10}$')
+ISBN13_RE = re.compile(r'^\d{13}$')
+SHOW_ID_RE = re.compile(r'/show/(\d+)')
+BR_RE = re.compile(r'<br\s*/?>')
+JSONLD_RE = re.compile(rb'<script[^>]+type="application/ld\+json"[^>]*>(.*?)</script>', re.DOTALL)
+
+# Descargas de fichas en paralelo (acotadas para no saturar Goodreads)
+CONCURRENCY = 10
+
+# Timeout (segundos) de cada petición, para no quedarse colgado en un socket
+REQUEST_TIMEOUT = 15
+
+# Ritmo máximo de peticiones a Goodreads (por segundo, entre todas las tareas).
+# Se puede cambiar con --max-rate.
+MAX_RATE = 2
+
+# Reintentos ante 429/5xx: backoff exponencial con jitter
+RETRY_STATUS = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1     # segundos
+BACKOFF_CAP = 60     # segundos
+MAX_RETRIES = 5
+
+# Escritura por lotes: se vuelca al fichero cada N libros o cada X segundos
+WRITE_BATCH_SIZE = 10
+WRITE_FLUSH_SECS = 2
+
+# Un único cliente HTTP/2 para búsqueda y fichas: todas las peticiones se
+# multiplexan sobre la misma conexión TLS con Goodreads
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=10, max_connections=20)
+
+# Caché del HTML descargado (bytes, tal cual llega): las re-ejecuciones (o un
+# re-parseo tras cambiar el parser) no vuelven a pedir a Goodreads las páginas
+# ya vistas
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+HTML_CACHE_TTL = 7 * 86400  # 7 días
+REDIS_TIMEOUT = 0.5         # segundos, para conectar y para cada operación
+
+
+def connect_cache():
+    """Cliente Redis si está instalado y accesible; si no, None (sin caché)."""
+    if redis is None:
+        return None
+    try:
+        client = redis.Redis.from_url(REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT,
+                                      socket_timeout=REDIS_TIMEOUT)
+        client.ping()
+        return client
+    except redis.RedisError:
+        return None
+
+
+# Se conecta en main(); importar el módulo no toca Redis
+CACHE = None
+
+
+# El cliente Redis es síncrono: sus llamadas van a un hilo para no
+# bloquear el event loop mientras hay descargas en curso.
+async def cache_get(key):
+    if CACHE is None:
+        return None
+    try:
+        return await asyncio.to_thread(CACHE.get, key)
+    except redis.RedisError:
+        return None
+
+
+async def cache_set(key, html):
+    if CACHE is None:
+        return
+    try:
+        await asyncio.to_thread(CACHE.setex, key, HTML_CACHE_TTL, html)
+    except redis.RedisError:
+        pass
+
 # --- 2. DATACLASS ---
-@dataclass
+@dataclass(slots=True)
 class BookData:
     id: str
     isbn10: Optional[str] = None       
@@ -48,51 +135,118 @@ class BookData:
 def clean_text_deep(text):
     """Limpia descripciones HTML complejas"""
     if not text: return None
-    text = text.replace("<br>", "\n").replace("<br />", "\n")
-    soup = BeautifulSoup(text, "html.parser")
-    return soup.get_text(separator="\n").strip()
+    # Sin etiquetas, entidades ni \r no hay nada que el parser vaya a cambiar
+    if "<" not in text and "&" not in text and "\r" not in text:
+        return text.strip()
+    text = BR_RE.sub("\n", text)
+    return LexborHTMLParser(text).text(separator="\n").strip()
+
+def narrow(tree, selector):
+    """
+    Nodo contenedor de la zona de la página que interesa, para que las
+    búsquedas CSS posteriores no recorran todo el DOM. Si Goodreads cambia
+    el marcado y no aparece, se usa la página entera.
+    """
+    return tree.css_first(selector) or tree
 
-def extract_pages_from_html(soup):
+def extract_pages_from_html(tree):
     """Intenta extraer el número de páginas del HTML si no está en el JSON"""
     try:
-        p_tag = soup.find("p", {"data-testid": "pagesFormat"})
+        p_tag = tree.css_first('p[data-testid="pagesFormat"]')
         if p_tag:
-            match = re.search(r'(\d+)', p_tag.get_text())
+            match = PAGES_RE.search(p_tag.text())
             if match: return int(match.group(1))
     except: pass
     return None
 
-def extract_publisher_info(soup, json_publisher):
+def extract_publisher_info(tree, json_publisher):
     """Estrategia híbrida para sacar el Publisher"""
     if json_publisher: return json_publisher
     try:
-        pub_tag = soup.find("p", {"data-testid": "publicationInfo"})
+        pub_tag = tree.css_first('p[data-testid="publicationInfo"]')
         if pub_tag:
-            text = pub_tag.get_text()
+            text = pub_tag.text()
             if " by " in text:
                 return text.split(" by ")[-1].strip()
     except: pass
     return None
 
 # --- 4. SCRAPER PRINCIPAL ---
-def get_book_details(book_id):
+def backoff_delay(attempt, retry_after=None):
+    """
+    Espera antes de reintentar una petición.
+    Respeta Retry-After (en segundos) si Goodreads lo envía;
+    si no, backoff exponencial con tope y jitter.
+    """
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.random()
+
+async def fetch_html(client, throttler, url, params=None):
+    """
+    HTML (bytes) de una página, reintentando con backoff ante 429/5xx o
+    fallos de red. Cada intento pasa por el throttler. None si no hay forma
+    de conseguirla.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with throttler:
+                resp = await client.get(url, params=params)
+            if resp.status_code == 200:
+                return resp.content
+            if resp.status_code not in RETRY_STATUS:
+                return None
+            retry_after = resp.headers.get("Retry-After")
+        except httpx.TransportError:
+            pass
+        except httpx.HTTPError:
+            # Bucle de redirecciones, contenido mal codificado...: reintentar
+            # no lo arregla; se pierde esta página, no la ejecución
+            return None
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+    return None
+
+async def get_book_details(client, throttler, book_id, ingestion_date=None):
+    """Descarga la ficha del libro y la convierte en BookData (None si falla)."""
     url = BASE_BOOK_URL + str(book_id)
-    try:
-        resp = requests.get(url, headers=HEADERS)
-        if resp.status_code != 200:
+    cache_key = f"gr:book:{book_id}:html"
+
+    html = await cache_get(cache_key)
+    if html is None:
+        html = await fetch_html(client, throttler, url)
+        if html is None:
             return None
-    except Exception:
-        return None
+        await cache_set(cache_key, html)
+
+    return parse_book_page(book_id, url, html, ingestion_date)
 
-    html = resp.text
-    soup = BeautifulSoup(html, "html.parser")
+
+def parse_book_page(book_id, url, html, ingestion_date=None):
+    """
+    Extrae los datos del libro del HTML (bytes) de su ficha; el único
+    decodificado lo hace el parser. ingestion_date la fija quien llama
+    (una por ejecución); si no, ahora en UTC.
+    """
+    tree = LexborHTMLParser(html)
 
     # --- A. JSON-LD (Datos estructurados ocultos) ---
+    # Se localiza con una regex sobre el HTML crudo; el selector CSS queda
+    # solo como respaldo por si el <script> viene con otro formato.
     book_json = {}
-    script_tag = soup.find("script", {"type": "application/ld+json"})
-    if script_tag:
+    m = JSONLD_RE.search(html)
+    if m:
+        raw_json = m.group(1)
+    else:
+        script_tag = tree.css_first('script[type="application/ld+json"]')
+        raw_json = script_tag.text() if script_tag else None
+    if raw_json:
         try:
-            data = json.loads(script_tag.string)
+            data = orjson.loads(raw_json)
             if isinstance(data, list):
                 for item in data:
                     if item.get("@type") == "Book":
@@ -103,16 +257,20 @@ def get_book_details(book_id):
         except:
             pass
 
+    # Fallbacks HTML para título y descripción
+    og_title = narrow(tree, "head").css_first('meta[property="og:title"]')
+    desc_div = tree.css_first('div[data-testid="description"]')
+
     # Crear objeto BookData inicial
     bd = BookData(
         id=str(book_id),
-        title=book_json.get('name') or (soup.find("meta", property="og:title") or {}).get("content"),
+        title=book_json.get('name') or (og_title.attributes.get("content") if og_title else None),
         desc=clean_text_deep(book_json.get('description') or
-                             (soup.find("div", {"data-testid": "description"}) or {}).get_text(separator="\n")),
+                             (desc_div.text(separator="\n") if desc_div else None)),
         authors=[],
         categories=[],
         url=url,
-        ingestion_date=datetime.now().isoformat()
+        ingestion_date=ingestion_date or datetime.now(timezone.utc).isoformat()
     )
 
     # Autores
@@ -125,15 +283,16 @@ def get_book_details(book_id):
                 bd.authors = [raw_author.get('name')]
 
     # Categorías
-    cats_list = []
-    for link in soup.find_all("a", href=re.compile(r'/genres/')):
-        g = link.get_text(strip=True)
-        if g and len(g) > 2 and g not in cats_list:
-            cats_list.append(g)
-    bd.categories = list(set(cats_list))[:5]
+    cats = {}
+    for link in narrow(tree, '[data-testid="genresList"]').css('a[href*="/genres/"]'):
+        g = link.text(strip=True)
+        if g and len(g) > 2 and g not in cats:
+            cats[g] = None
+            if len(cats) == 5: break
+    bd.categories = list(cats)
 
     # Formato y páginas
-    bd.num_pages = book_json.get('numberOfPages') or extract_pages_from_html(soup)
+    bd.num_pages = book_json.get('numberOfPages') or extract_pages_from_html(tree)
     bd.format = book_json.get('bookFormat')
 
     # Ratings
@@ -144,13 +303,13 @@ def get_book_details(book_id):
     # Fecha de publicación inicial y publisher
     bd.pub_date = book_json.get('datePublished')
     json_pub_name = book_json.get('publisher', {}).get('name') if isinstance(book_json.get('publisher'), dict) else None
-    bd.publisher = extract_publisher_info(soup, json_pub_name)
+    bd.publisher = extract_publisher_info(tree, json_pub_name)
 
     # --- B. JSON embebido (opcional, para ISBN-10 y publisher alternativo) ---
     try:
-        match = re.search(r'"details"\s*:\s*({.*?})\s*,\s*"', html, flags=re.DOTALL)
+        match = DETAILS_RE.search(html)
         if match:
-            details = json.loads(match.group(1))
+            details = orjson.loads(match.group(1))
             # Publisher
             publisher = details.get("publisher")
             if isinstance(publisher, dict):
@@ -189,24 +348,25 @@ def get_book_details(book_id):
     # --- C. Último intento de ISBN desde la página si sigue faltando ---
     if not bd.isbn10 or not bd.isbn13:
         try:
-            info_rows = soup.find_all("div", class_="infoBoxRowItem")
-            for div in info_rows:
-                text = div.get_text(strip=True)
-                if re.match(r'^\d{10}$', text) and not bd.isbn10:
+            for div in tree.css("div.infoBoxRowItem"):
+                text = div.text(strip=True)
+                if ISBN10_RE.match(text) and not bd.isbn10:
                     bd.isbn10 = text
-                elif re.match(r'^\d{13}$', text) and not bd.isbn13:
+                elif ISBN13_RE.match(text) and not bd.isbn13:
                     bd.isbn13 = text
+                if bd.isbn10 and bd.isbn13: break
         except:
             pass
 
     return bd
 
 
-def get_book_ids_from_search(query, target_count=15):
+async def get_book_ids_from_search(client, throttler, query, target_count=15):
     """
     Busca páginas sucesivamente (page=1, page=2...) hasta encontrar 'target_count' libros únicos.
     """
     found_ids = []
+    seen = set()
     current_page = 1
     
     print(f"--- Buscando '{query}' (Objetivo: {target_count} libros) ---")
@@ -215,15 +375,20 @@ def get_book_ids_from_search(query, target_count=15):
         print(f" -> Escrapeando página de búsqueda {current_page}...")
         
         params = {'q': query, 'page': current_page, 'search_type': 'books'}
+        cache_key = f"gr:search:{query}:{current_page}"
         
         try:
-            resp = requests.get(SEARCH_URL, headers=HEADERS, params=params)
-            if resp.status_code != 200:
-                print("Error en la búsqueda o bloqueo de IP.")
-                break
+            html = await cache_get(cache_key)
+            from_cache = html is not None
+            if not from_cache:
+                html = await fetch_html(client, throttler, SEARCH_URL, params)
+                if html is None:
+                    print("Error en la búsqueda o bloqueo de IP.")
+                    break
+                await cache_set(cache_key, html)
                 
-            soup = BeautifulSoup(resp.text, "html.parser")
-            links = soup.find_all("a", class_="bookTitle")
+            tree = LexborHTMLParser(html)
+            links = narrow(tree, "table.tableList").css("a.bookTitle")
             
             if not links:
                 print(" -> No hay más resultados.")
@@ -231,10 +396,11 @@ def get_book_ids_from_search(query, target_count=15):
             
             new_ids_found_on_page = 0
             for link in links:
-                match = re.search(r'/show/(\d+)', link.get('href'))
+                match = SHOW_ID_RE.search(link.attributes.get('href') or "")
                 if match:
                     bid = match.group(1)
-                    if bid not in found_ids:
+                    if bid not in seen:
+                        seen.add(bid)
                         found_ids.append(bid)
                         new_ids_found_on_page += 1
                         
@@ -244,7 +410,8 @@ def get_book_ids_from_search(query, target_count=15):
             print(f"    Encontrados {new_ids_found_on_page} nuevos en esta página.")
             
             current_page += 1
-            time.sleep(1) # Pausa breve
+            if not from_cache:
+                await asyncio.sleep(1) # Pausa breve
 
         except Exception as e:
             print(f"Error: {e}")
@@ -253,7 +420,114 @@ def get_book_ids_from_search(query, target_count=15):
     return found_ids[:target_count]
 
 # --- 5. EJECUCIÓN ROBUSTA ---
-if __name__ == "__main__":
+async def scrape_books(client, throttler, ids_to_scrape, existing_ids):
+    """
+    Descarga las fichas en paralelo (como mucho CONCURRENCY a la vez) y
+    las guarda en modo append desde un único consumidor, para que las
+    escrituras al fichero nunca se entrelacen. El ritmo global de peticiones
+    lo marca el token bucket `throttler`. El consumidor agrupa los libros y
+    los vuelca por lotes (WRITE_BATCH_SIZE / WRITE_FLUSH_SECS).
+    """
+    queue = asyncio.Queue()
+    sem = asyncio.Semaphore(CONCURRENCY)
+    ingestion_date = datetime.now(timezone.utc).isoformat()
+    total = len(ids_to_scrape)
+
+    # Marca que el temporizador mete en la cola para volcar el lote
+    flush_due = object()
+
+    async def fetch(i, bid):
+        # Siempre encola algo: un fallo inesperado pierde ese libro, no la ejecución
+        bk = None
+        try:
+            async with sem:
+                bk = await get_book_details(client, throttler, bid, ingestion_date)
+        except Exception as e:
+            print(f"[{i+1}] Error inesperado con {bid}: {e!r}")
+        await queue.put((i, bid, bk))
+
+    async def writer():
+        loop = asyncio.get_running_loop()
+        records, ids = [], []
+        timer = None
+        with open(OUTPUT_FILE, 'a', encoding='utf-8') as f, \
+             open(IDS_FILE, 'a', encoding='utf-8') as f_ids:
+
+            def flush():
+                nonlocal timer
+                if timer is not None:
+                    timer.cancel()
+                    timer = None
+                # El .ids se escribe después del JSONL (ver load_existing_ids)
+                if records:
+                    f.write("".join(records))
+                    f.flush()
+                    f_ids.write("".join(ids))
+                    f_ids.flush()
+                    records.clear()
+                    ids.clear()
+
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if item is flush_due:
+                        flush()
+                        continue
+                    i, bid, bk = item
+
+                    # Doble check
+                    if bid in existing_ids: continue
+
+                    if bk and bk.title:
+                        records.append(orjson.dumps(bk).decode() + "\n")  # orjson serializa dataclasses
+                        ids.append(bid + "\n")
+                        existing_ids.add(bid)
+                        print(f"[{i+1}/{total}] Guardado: {bk.title[:30]}...")
+                        if timer is None:
+                            timer = loop.call_later(WRITE_FLUSH_SECS,
+                                                    queue.put_nowait, flush_due)
+                        if len(records) >= WRITE_BATCH_SIZE:
+                            flush()
+                    else:
+                        print(f"[{i+1}] Error recuperando detalles.")
+            finally:
+                flush()
+
+    writer_task = asyncio.create_task(writer())
+    try:
+        await asyncio.gather(*(fetch(i, bid) for i, bid in enumerate(ids_to_scrape)))
+    finally:
+        # El centinela llega aunque gather falle o se cancele
+        await queue.put(None)
+        await writer_task
+
+
+def load_existing_ids():
+    """
+    IDs ya guardados. Se leen del fichero .ids; si no existe o es más
+    antiguo que el JSONL (editado a mano, borrado...), se reconstruye
+    recorriendo el JSONL.
+    """
+    if IDS_FILE.exists() and IDS_FILE.stat().st_mtime >= OUTPUT_FILE.stat().st_mtime:
+        return set(IDS_FILE.read_text(encoding='utf-8').split())
+
+    existing_ids = set()
+    with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    existing_ids.add(orjson.loads(line)['id'])
+                except: pass
+    IDS_FILE.write_text("".join(f"{bid}\n" for bid in existing_ids), encoding='utf-8')
+    return existing_ids
+
+
+async def main(max_rate=MAX_RATE):
+    global CACHE
+    CACHE = connect_cache()
+
     TERMINO = "Data Science"
     CANTIDAD_OBJETIVO = 20 
     
@@ -263,40 +537,39 @@ if __name__ == "__main__":
         print(f"> Archivo '{OUTPUT_FILE.name}' no existía. Creado vacío.")
     
     # B) Cargar IDs previos (Deduplicación)
-    existing_ids = set()
-    with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.strip():
-                try:
-                    existing_ids.add(json.loads(line)['id'])
-                except: pass
+    existing_ids = load_existing_ids()
     
     print(f"> IDs ya existentes en el archivo: {len(existing_ids)}")
     
-    # C) Buscar IDs nuevos
-    ids = get_book_ids_from_search(TERMINO, target_count=CANTIDAD_OBJETIVO)
-    ids_to_scrape = [bid for bid in ids if bid not in existing_ids]
-    
-    print(f"\n>>> Se procesarán {len(ids_to_scrape)} libros nuevos.\n")
+    # Throttler admite ceil(rate_limit) peticiones por periodo: con una por
+    # periodo de 1/max_rate el tope es exacto también para ritmos fraccionarios
+    throttler = Throttler(rate_limit=1, period=1 / max_rate)
+    # follow_redirects: Goodreads redirige fichas y búsquedas (httpx, a
+    # diferencia de requests/aiohttp, no sigue redirecciones por defecto)
+    async with httpx.AsyncClient(http2=True, headers=HEADERS, limits=HTTP_LIMITS,
+                                 timeout=REQUEST_TIMEOUT,
+                                 follow_redirects=True) as client:
+        # C) Buscar IDs nuevos
+        ids = await get_book_ids_from_search(client, throttler, TERMINO,
+                                             target_count=CANTIDAD_OBJETIVO)
+        ids_to_scrape = [bid for bid in ids if bid not in existing_ids]
 
-    # D) Guardar en modo Append
-    if ids_to_scrape:
-        with open(OUTPUT_FILE, 'a', encoding='utf-8') as f:
-            for i, bid in enumerate(ids_to_scrape):
-                # Doble check
-                if bid in existing_ids: continue
+        print(f"\n>>> Se procesarán {len(ids_to_scrape)} libros nuevos.\n")
 
-                bk = get_book_details(bid)
-                
-                if bk and bk.title:
-                    f.write(json.dumps(asdict(bk), ensure_ascii=False) + "\n")
-                    existing_ids.add(bid)
-                    print(f"[{i+1}/{len(ids_to_scrape)}] Guardado: {bk.title[:30]}...")
-                else:
-                    print(f"[{i+1}] Error recuperando detalles.")
-                
-                time.sleep(random.uniform(1.0, 2.0))
-    else:
-        print(">>> ¡Objetivo cumplido! Ya tenías todos estos libros.")
+        # D) Descargar y guardar en modo Append
+        if ids_to_scrape:
+            await scrape_books(client, throttler, ids_to_scrape, existing_ids)
+        else:
+            print(">>> ¡Objetivo cumplido! Ya tenías todos estos libros.")
+
+    print(f"\n>>> FINALIZADO. Total libros en archivo: {len(existing_ids)}")
 
-    print(f"\n>>> FINALIZADO. Total libros en archivo: {len(existing_ids)}")
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scraper de Goodreads")
+    parser.add_argument("--max-rate", type=float, default=MAX_RATE,
+                        help=f"peticiones a Goodreads por segundo (por defecto {MAX_RATE})")
+    args = parser.parse_args()
+    if args.max_rate <= 0:
+        parser.error("--max-rate debe ser mayor que 0")
+    asyncio.run(main(args.max_rate))